@@ -1,19 +1,36 @@
 import sys
 import os
+import io
+import logging
 import shutil
+import hashlib
+import threading
 import sqlite3
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import PIL
+from PIL import Image, features
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QLabel, QVBoxLayout, QHBoxLayout,
     QPushButton, QFileDialog, QTableView, QMessageBox,
     QDialog, QFormLayout, QSlider, QComboBox, QDialogButtonBox,
     QAbstractItemView, QStyledItemDelegate, QHeaderView, QSpinBox
 )
-from PyQt5.QtCore import Qt, QMimeData, QAbstractTableModel, QVariant, QModelIndex
+from PyQt5.QtCore import (
+    Qt, QMimeData, QAbstractTableModel, QModelIndex,
+    QObject, QRunnable, QThreadPool, pyqtSignal
+)
 
 # Constants
 DB_FILE = 'images.db'
 IMAGES_DIR = 'stored_images'
+COPY_WORKERS = 8
+SUPPORTED_EXTS = frozenset({'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp'})
+DITHER_MODES = {
+    'Floyd-Steinberg': Image.Dither.FLOYDSTEINBERG,
+    'None (threshold)': Image.Dither.NONE,
+}
+
+log = logging.getLogger(__name__)
 
 
 def ensure_images_dir():
@@ -21,79 +38,199 @@ def ensure_images_dir():
         os.makedirs(IMAGES_DIR)
 
 
+def unique_name(base, ext, taken):
+    # First of base+ext, base_1+ext, base_2+ext, ... not in taken (a set of os.path.normcase'd names,
+    # case-insensitive file systems), the returned name is added to taken
+    name = f"{base}{ext}"
+    i = 1
+    while os.path.normcase(name) in taken:
+        name = f"{base}_{i}{ext}"
+        i += 1
+    taken.add(os.path.normcase(name))
+    return name
+
+
+def is_supported_image(path):
+    # Called at mouse-move rate from dragEnterEvent, cheaper than os.path.splitext
+    dot = path.rfind('.')
+    return dot >= 0 and path[dot:].lower() in SUPPORTED_EXTS
+
+
+def file_hash(path):
+    # BLAKE2b runs close to disk speed, the file is streamed in chunks by hashlib.file_digest
+    with open(path, 'rb') as fh:
+        return hashlib.file_digest(fh, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
+def build_save_fn(options):
+    # Pick the encoder call once per run instead of branching on the format for every image
+    fmt = options['format']
+    quality = options['quality']
+
+    def save_jpeg(img, fp):
+        img.save(fp, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+    def save_webp(img, fp):
+        img.save(fp, 'WEBP', quality=quality, method=6)
+
+    def save_png(img, fp):
+        img.save(fp, 'PNG', optimize=True)
+
+    def save_plain(img, fp):
+        img.save(fp, fmt)
+
+    return {'JPEG': save_jpeg, 'WEBP': save_webp, 'PNG': save_png}.get(fmt, save_plain)
+
+
+def write_file(path, data):
+    # Write the encoded image with as few unbuffered os.write calls as possible
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def log_pillow_build():
+    # pillow-simd releases are versioned like the Pillow release they are based on plus a .postN suffix
+    if '.post' in PIL.__version__:
+        log.info("Using pillow-simd %s (SIMD build active)", PIL.__version__)
+    else:
+        log.info("Using Pillow %s (no SIMD build, see README)", PIL.__version__)
+    jpeglib_version = getattr(Image.core, 'jpeglib_version', 'unknown')
+    if features.check_feature('libjpeg_turbo'):
+        log.info("JPEG codec: libjpeg-turbo %s", jpeglib_version)
+    else:
+        log.info("JPEG codec: libjpeg %s (no libjpeg-turbo, see README)", jpeglib_version)
+
+
 class ImageDatabase:
     def __init__(self, db_path=DB_FILE):
-        self.conn = sqlite3.connect(db_path)
+        # One connection shared by all threads in autocommit mode, statements are serialized by the lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.conn.execute('PRAGMA mmap_size=268435456')
         self._create_table()
 
     def _create_table(self):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT NOT NULL,
-                filepath TEXT NOT NULL UNIQUE
-            )
-        ''')
-        self.conn.commit()
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    filepath TEXT NOT NULL UNIQUE,
+                    content_hash TEXT
+                )
+            ''')
+            # Databases created before content hashes were stored lack the column
+            columns = [row[1] for row in cursor.execute('PRAGMA table_info(images)')]
+            if 'content_hash' not in columns:
+                cursor.execute('ALTER TABLE images ADD COLUMN content_hash TEXT')
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash)')
 
     def add_image(self, filename, filepath):
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute('INSERT INTO images (filename, filepath) VALUES (?,?)', (filename, filepath))
-            self.conn.commit()
-            return cursor.lastrowid
-        except sqlite3.IntegrityError:
-            # file already exists in DB
-            return None
+        with self._lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('INSERT INTO images (filename, filepath) VALUES (?,?)', (filename, filepath))
+                return cursor.lastrowid
+            except sqlite3.IntegrityError:
+                # file already exists in DB
+                return None
+
+    def add_images_bulk(self, rows):
+        # Insert all (filename, filepath, content_hash) rows in a single transaction, returns the number of added rows
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+            try:
+                cursor.executemany('INSERT OR IGNORE INTO images (filename, filepath, content_hash) VALUES (?,?,?)', rows)
+                added_count = cursor.rowcount
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return added_count
+
+    def has_content_hash(self, content_hash):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT 1 FROM images WHERE content_hash=?', (content_hash,))
+            return cursor.fetchone() is not None
 
     def get_all_images(self):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id, filename, filepath FROM images ORDER BY id DESC')
-        return cursor.fetchall()
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT id, filename, filepath FROM images ORDER BY id DESC')
+            return cursor.fetchall()
+
+    def get_images_since(self, last_id):
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT id, filename, filepath FROM images WHERE id > ? ORDER BY id DESC', (last_id,))
+            return cursor.fetchall()
 
     def update_image_path(self, image_id, new_filepath):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE images SET filepath=? WHERE id=?', (new_filepath, image_id))
-        self.conn.commit()
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('UPDATE images SET filepath=? WHERE id=?', (new_filepath, image_id))
 
     def delete_image(self, image_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM images WHERE id=?', (image_id,))
-        self.conn.commit()
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM images WHERE id=?', (image_id,))
 
 
 class ImageTableModel(QAbstractTableModel):
     def __init__(self, db: ImageDatabase):
         super().__init__()
         self.db = db
-        self.images = []
+        # Rows are kept column-wise (ids, filenames, filepaths) so column scans for filters or
+        # lookups touch a single list instead of every row tuple
+        self.columns = ([], [], [])
+        self._last_id = 0
         self.refresh()
 
+    @staticmethod
+    def _split_columns(rows):
+        ids, filenames, filepaths = zip(*rows) if rows else ((), (), ())
+        return list(ids), list(filenames), list(filepaths)
+
     def refresh(self):
         self.beginResetModel()
-        self.images = self.db.get_all_images()
+        self.columns = self._split_columns(self.db.get_all_images())
+        ids = self.columns[0]
+        self._last_id = ids[0] if ids else 0
         self.endResetModel()
 
+    def append_new(self):
+        # Insert rows added since the last load at the top instead of resetting the whole model
+        new_images = self.db.get_images_since(self._last_id)
+        if not new_images:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(new_images) - 1)
+        for column, new_values in zip(self.columns, self._split_columns(new_images)):
+            column[0:0] = new_values
+        self._last_id = new_images[0][0]
+        self.endInsertRows()
+
     def rowCount(self, parent=QModelIndex()):
-        return len(self.images)
+        return len(self.columns[0])
 
     def columnCount(self, parent=QModelIndex()):
         return 3  # ID, filename, filepath
 
     def data(self, index, role=Qt.DisplayRole):
-        if not index.isValid():
-            return QVariant()
-        image = self.images[index.row()]
-        col = index.column()
-        if role == Qt.DisplayRole:
-            if col == 0:
-                return image[0]  # id
-            elif col == 1:
-                return image[1]  # filename
-            elif col == 2:
-                return image[2]  # filepath
-        return QVariant()
+        # Called for every cell and role on paint, keep it cheap. None is an invalid QVariant for PyQt5
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return self.columns[index.column()][index.row()]
 
     def headerData(self, section, orientation, role=Qt.DisplayRole):
         headers = ['ID', 'Filename', 'File path']
@@ -133,15 +270,12 @@ class DragDropWidget(QWidget):
         self.setLayout(layout)
 
     def dragEnterEvent(self, event):
-        if event.mimeData().hasUrls():
-            # Accept only if urls contain at least one supported image extension
-            urls = event.mimeData().urls()
-            for url in urls:
-                if url.isLocalFile():
-                    ext = os.path.splitext(url.toLocalFile())[1].lower()
-                    if ext in ['.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp']:
-                        event.acceptProposedAction()
-                        return
+        mime_data = event.mimeData()
+        # Accept only if urls contain at least one supported image extension
+        if mime_data.hasUrls() and any(url.isLocalFile() and is_supported_image(url.toLocalFile())
+                                       for url in mime_data.urls()):
+            event.acceptProposedAction()
+            return
         event.ignore()
 
     def dropEvent(self, event):
@@ -149,32 +283,57 @@ class DragDropWidget(QWidget):
         for url in event.mimeData().urls():
             if url.isLocalFile():
                 filepath = url.toLocalFile()
-                ext = os.path.splitext(filepath)[1].lower()
-                if ext in ['.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tiff', '.webp']:
+                if is_supported_image(filepath):
                     files.append(filepath)
 
         if not files:
             QMessageBox.information(self, "No images", "No supported image files dropped.")
             return
 
-        added_count = 0
-        for f in files:
-            filename = os.path.basename(f)
-            # Copy image into IMAGES_DIR with a unique name if collision
-            target_path = os.path.join(IMAGES_DIR, filename)
-            base, ext = os.path.splitext(filename)
-            i = 1
-            while os.path.exists(target_path):
-                target_path = os.path.join(IMAGES_DIR, f"{base}_{i}{ext}")
-                i += 1
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as ex:
+            # Hash first so files already in the database are neither copied nor compressed again
+            hash_futures = [ex.submit(file_hash, f) for f in files]
+            new_files = []
+            seen = set()
+            skipped_count = 0
+            for f, future in zip(files, hash_futures):
+                try:
+                    content_hash = future.result()
+                except Exception as e:
+                    QMessageBox.warning(self, "Error", f"Could not add image {os.path.basename(f)}:\n{e}")
+                    continue
+                if content_hash in seen or self.db.has_content_hash(content_hash):
+                    skipped_count += 1
+                    continue
+                seen.add(content_hash)
+                new_files.append((f, content_hash))
+
+            # Resolve unique target names against a snapshot of IMAGES_DIR instead of probing the disk,
+            # names picked in this batch are added to the snapshot
+            pairs = []
+            taken = {os.path.normcase(name) for name in os.listdir(IMAGES_DIR)}
+            for f, content_hash in new_files:
+                # Copy image into IMAGES_DIR with a unique name if collision
+                base, ext = os.path.splitext(os.path.basename(f))
+                target_name = unique_name(base, ext, taken)
+                pairs.append((f, os.path.join(IMAGES_DIR, target_name), content_hash))
+
+            # Copying is IO bound, run the copies concurrently
+            futures = [ex.submit(shutil.copy2, f, target_path) for f, target_path, _ in pairs]
+
+        rows = []
+        for (f, target_path, content_hash), future in zip(pairs, futures):
             try:
-                shutil.copy2(f, target_path)
-                if self.db.add_image(os.path.basename(target_path), target_path):
-                    added_count += 1
+                future.result()
+                rows.append((os.path.basename(target_path), target_path, content_hash))
             except Exception as e:
-                QMessageBox.warning(self, "Error", f"Could not add image {filename}:\n{e}")
-        self.model.refresh()
-        QMessageBox.information(self, "Images added", f"Successfully added {added_count} image(s).")
+                QMessageBox.warning(self, "Error", f"Could not add image {os.path.basename(f)}:\n{e}")
+        added_count = self.db.add_images_bulk(rows) if rows else 0
+        self.model.append_new()
+        message = f"Successfully added {added_count} image(s)."
+        if skipped_count:
+            message += f"\nSkipped {skipped_count} duplicate image(s)."
+        QMessageBox.information(self, "Images added", message)
 
 
 class CompressionDialog(QDialog):
@@ -185,6 +344,7 @@ class CompressionDialog(QDialog):
         self.compression_quality = 75
         self.bit_depth = 8
         self.format = 'JPEG'
+        self.dither = 'Floyd-Steinberg'
         self.init_ui()
 
     def init_ui(self):
@@ -205,6 +365,12 @@ class CompressionDialog(QDialog):
         self.bit_depth_combo.setCurrentText(str(self.bit_depth))
         form.addRow("Bit Depth:", self.bit_depth_combo)
 
+        # Dithering combo, only used for 1-bit output
+        self.dither_combo = QComboBox()
+        self.dither_combo.addItems(list(DITHER_MODES))
+        self.dither_combo.setCurrentText(self.dither)
+        form.addRow("Dithering (1 bit):", self.dither_combo)
+
         # Format combo
         self.format_combo = QComboBox()
         self.format_combo.addItems(['JPEG', 'PNG', 'WEBP', 'BMP'])
@@ -225,10 +391,71 @@ class CompressionDialog(QDialog):
         return {
             'quality': self.slider.value(),
             'bit_depth': int(self.bit_depth_combo.currentText()),
-            'format': self.format_combo.currentText()
+            'format': self.format_combo.currentText(),
+            'dither': self.dither_combo.currentText()
         }
 
 
+class CompressSignals(QObject):
+    finished = pyqtSignal(int, str)  # image id, new file path
+    failed = pyqtSignal(str, str)  # filename, error message
+
+
+class CompressTask(QRunnable):
+    # Compresses a single image on a QThreadPool worker thread
+    def __init__(self, image_id, filename, filepath, new_filepath, settings, signals: CompressSignals):
+        super().__init__()
+        self.image_id = image_id
+        self.filename = filename
+        self.filepath = filepath
+        self.new_filepath = new_filepath
+        self.settings = settings
+        self.signals = signals
+
+    def run(self):
+        settings = self.settings
+        filepath = self.filepath
+        new_filepath = self.new_filepath
+        try:
+            # Opened by path so Pillow can memory-map uncompressed BMP/TIFF files itself
+            source = Image.open(filepath)
+            try:
+                img = source
+                bit_depth = settings['bit_depth']
+                if source.format == 'JPEG' and bit_depth in (1, 16):
+                    # Grayscale targets: let libjpeg decode the luma channel only, skipping chroma upsampling
+                    # and the YCbCr->RGB conversion. Size is kept, so the scaled IDCT path is not used.
+                    source.draft('L', source.size)
+                # Convert bit depth
+                # convert() to the mode an image already has still copies the whole pixel buffer, skip it
+                if bit_depth == 1:
+                    # 1-bit pixels, black and white, stored with one pixel per byte
+                    if img.mode != '1':
+                        img = img.convert('1', dither=settings['dither'])
+                elif bit_depth == 8:
+                    target_mode = 'RGB' if img.mode in ('RGB', 'RGBA') else 'L'
+                    if img.mode != target_mode:
+                        img = img.convert(target_mode)
+                elif bit_depth == 16:
+                    # Pillow doesn't provide direct 16-bit per channel conversion, use 16-bit grayscale if possible
+                    if img.mode in ['I;16', 'I;16B']:
+                        pass
+                    else:
+                        img = img.convert('I;16')  # 16-bit grayscale
+                # Encode in memory first, a failing encoder then never truncates the target file
+                buf = io.BytesIO()
+                settings['save_fn'](img, buf)
+                with buf.getbuffer() as data:
+                    write_file(new_filepath, data)
+            finally:
+                # Release the file handle and memory map right away, also if compression fails
+                source.close()
+        except Exception as e:
+            self.signals.failed.emit(self.filename, str(e))
+        else:
+            self.signals.finished.emit(self.image_id, new_filepath)
+
+
 class MainWindow(QWidget):
     def __init__(self):
         super().__init__()
@@ -279,51 +506,93 @@ class MainWindow(QWidget):
             QMessageBox.information(self, "No images","No images in the database to compress.")
             return
 
+        # Everything that only depends on the options is prepared once for all tasks
+        settings = {
+            'bit_depth': options['bit_depth'],
+            'dither': DITHER_MODES[options['dither']],
+            'save_fn': build_save_fn(options),
+        }
+
+        # Resolve unique output paths before any task starts: rows with the same filename stem
+        # (a.png, a.jpg) must not write the same file concurrently. A row may keep its own current
+        # path, names already on disk, used by another DB row (even if the file is gone) or picked
+        # in this run get a _1, _2, ... suffix like in dropEvent.
+        ext = f".{options['format'].lower()}"
+        taken = {os.path.normcase(name) for name in os.listdir(IMAGES_DIR)}
+        taken.update(os.path.normcase(os.path.basename(filepath)) for _, _, filepath in images)
+        new_filepaths = {}
         for image_id, filename, filepath in images:
+            base = f"{os.path.splitext(filename)[0]}_compressed"
+            own_name = os.path.normcase(os.path.basename(filepath))
+            # The row's own path stays reserved for the other rows, a failed task keeps pointing to it
+            taken.discard(own_name)
+            target_name = unique_name(base, ext, taken)
+            taken.add(own_name)
+            new_filepaths[image_id] = os.path.join(IMAGES_DIR, target_name)
+
+        # Results are applied on the main thread as each task finishes, SQLite is never used from a worker
+        self._compress_total = total
+        self._compress_done = 0
+        self._compress_paths = {image_id: filepath for image_id, _, filepath in images}
+        self._compress_errors = []
+        self._compress_signals = CompressSignals()
+        self._compress_signals.finished.connect(self._on_image_compressed)
+        self._compress_signals.failed.connect(self._on_image_failed)
+        self.compress_btn.setEnabled(False)
+        self.compress_btn.setText(f"Compressing 0/{total}...")
+        # Drops during a run could take output names that are reserved but not written yet
+        self.dragdrop.setAcceptDrops(False)
+
+        pool = QThreadPool.globalInstance()
+        pool.setMaxThreadCount(os.cpu_count() or 1)
+        for image_id, filename, filepath in images:
+            pool.start(CompressTask(image_id, filename, filepath, new_filepaths[image_id], settings,
+                                    self._compress_signals))
+
+    def _on_image_compressed(self, image_id, new_filepath):
+        # Point the DB entry to the new file before removing the old one, so an interrupted
+        # run never leaves rows referring to deleted files
+        filepath = self._compress_paths[image_id]
+        if filepath != new_filepath:
             try:
-                img = Image.open(filepath)
-                # Convert bit depth
-                if options['bit_depth'] == 1:
-                    img = img.convert('1')  # 1-bit pixels, black and white, stored with one pixel per byte
-                elif options['bit_depth'] == 8:
-                    img = img.convert('L') if img.mode != 'RGB' and img.mode != 'RGBA' else img.convert('RGB')
-                elif options['bit_depth'] == 16:
-                    # Pillow doesn't provide direct 16-bit per channel conversion, use 16-bit grayscale if possible
-                    if img.mode in ['I;16', 'I;16B']:
-                        pass
-                    else:
-                        img = img.convert('I;16')  # 16-bit grayscale
-                # Determine save params based on format
-                save_kwargs = {}
-                ext = options['format'].lower()
-                if options['format'] == 'JPEG':
-                    save_kwargs['quality'] = options['quality']
-                    save_kwargs['optimize'] = True
-                elif options['format'] == 'WEBP':
-                    save_kwargs['quality'] = options['quality']
-                    save_kwargs['method'] = 6
-                # Build new filename with extension
-                base = os.path.splitext(filename)[0]
-                new_filename = f"{base}_compressed.{ext}"
-                new_filepath = os.path.join(IMAGES_DIR, new_filename)
-                img.save(new_filepath, format=options['format'], **save_kwargs)
-
-                # Update DB entry to new file and remove old file
-                if filepath != new_filepath:
-                    try:
-                        os.remove(filepath)
-                    except Exception:
-                        pass
-                    self.db.update_image_path(image_id, new_filepath)
-
-            except Exception as e:
-                QMessageBox.warning(self, "Compression Error", f"Failed to compress {filename}:\n{e}")
+                self.db.update_image_path(image_id, new_filepath)
+            except sqlite3.Error as e:
+                # Exceptions must not escape a Qt slot, the old file is kept since the row still uses it
+                self._compress_errors.append(f"{os.path.basename(filepath)}: {e}")
+            else:
+                try:
+                    os.remove(filepath)
+                except Exception:
+                    pass
+        self._advance_compression()
+
+    def _on_image_failed(self, filename, message):
+        self._compress_errors.append(f"{filename}: {message}")
+        self._advance_compression()
+
+    def _advance_compression(self):
+        self._compress_done += 1
+        self.compress_btn.setText(f"Compressing {self._compress_done}/{self._compress_total}...")
+        if self._compress_done < self._compress_total:
+            return
 
         self.model.refresh()
-        QMessageBox.information(self, "Compression Complete", f"Completed compressing {total} image(s).")
+        self.compress_btn.setText("Compress Images")
+        self.compress_btn.setEnabled(True)
+        self.dragdrop.setAcceptDrops(True)
+
+        if self._compress_errors:
+            QMessageBox.warning(self, "Compression Error",
+                                "Failed to compress:\n" + "\n".join(self._compress_errors))
+        QMessageBox.information(self, "Compression Complete", f"Completed compressing {self._compress_total} image(s).")
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
+    log_pillow_build()
+    # Import all Pillow format plugins at startup, otherwise the first compression run pays for it
+    # on the worker threads (WEBP/TIFF are only loaded lazily by Image.open/save)
+    Image.init()
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()